@@ -4,17 +4,46 @@ Uses asyncpg for async PostgreSQL operations.
 All functions are safe: if DB is unavailable, they fail silently.
 """
 import os
+import asyncio
+import json
 import logging
-from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Tuple
+import time
+from datetime import datetime, timezone
+from functools import wraps
+from typing import Any, Optional, Dict, List, Tuple
 import asyncpg
 from contextlib import asynccontextmanager
+from dataclasses import dataclass
 
 logger = logging.getLogger(__name__)
 
 # Global connection pool
 _pool: Optional[asyncpg.Pool] = None
 
+# Write buffers: log_attempt/log_event enqueue rows here and a background
+# task per table flushes them with COPY in batches.
+BUFFER_MAXSIZE = 10000
+FLUSH_BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.5  # seconds
+FLUSH_DEADLOCK_RETRIES = 3
+# Errors caused by a row's own data: only these make a failed batch worth
+# retrying row by row. Timeouts and connection errors drop the batch.
+_ROW_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError)
+
+ATTEMPT_COLUMNS = [
+    "user_id", "question_id", "question_num", "user_answer",
+    "correct_answer", "is_correct", "difficulty", "topic", "created_at",
+]
+EVENT_COLUMNS = ["user_id", "event_type", "metadata", "created_at"]
+
+_ATTEMPT_BUFFER: Optional[asyncio.Queue] = None
+_EVENT_BUFFER: Optional[asyncio.Queue] = None
+_flush_tasks: Dict[str, asyncio.Task] = {}  # table -> flush task
+
+# Analytics results cache: (function name, args, kwargs) -> (timestamp, result)
+ANALYTICS_CACHE_TTL = 60  # seconds
+_CACHE: Dict[Tuple, Tuple[float, Any]] = {}
+
 
 async def init_db():
     """Initialize database connection pool."""
@@ -38,11 +67,15 @@ async def init_db():
     except Exception as e:
         logger.error(f"Failed to create database pool: {e}")
         _pool = None
+        return
+
+    _start_flushers()
 
 
 async def close_db():
-    """Close database connection pool."""
+    """Flush buffered writes and close database connection pool."""
     global _pool
+    await _stop_flushers()
     if _pool:
         await _pool.close()
         _pool = None
@@ -64,6 +97,77 @@ async def get_conn():
         yield None
 
 
+_USER_CONFLICT_SQL = """
+    ON CONFLICT (user_id) 
+    DO UPDATE SET 
+        username = COALESCE(EXCLUDED.username, users.username),
+        first_name = COALESCE(EXCLUDED.first_name, users.first_name),
+        last_name = COALESCE(EXCLUDED.last_name, users.last_name),
+        updated_at = NOW()
+"""
+
+# Upsert for the users table, parameterized as $1..$4 = user_id, username,
+# first_name, last_name. Used standalone and as a CTE in front of the
+# events/attempts inserts so that each log call is a single round-trip.
+_UPSERT_USER_SQL = f"""
+    INSERT INTO users (user_id, username, first_name, last_name)
+    VALUES ($1, $2, $3, $4)
+    {_USER_CONFLICT_SQL}
+    RETURNING user_id
+"""
+
+# attempts_hourly keeps running totals per UTC hour so that counts and accuracy
+# are read from a few hundred small rows instead of scanning attempts.
+_HOURLY_CONFLICT_SQL = """
+    ON CONFLICT (hour)
+    DO UPDATE SET
+        total = attempts_hourly.total + EXCLUDED.total,
+        correct = attempts_hourly.correct + EXCLUDED.correct
+"""
+
+# Adds a batch of per-hour counts, passed as three parallel arrays.
+_ADD_HOURLY_BULK_SQL = f"""
+    INSERT INTO attempts_hourly (hour, total, correct)
+    SELECT * FROM unnest($1::timestamptz[], $2::int[], $3::int[])
+    {_HOURLY_CONFLICT_SQL}
+"""
+
+# Single-row writes: the user upsert as a CTE, then the row as $5.. in column
+# order after user_id. Used when the batch writer is not running and to write
+# a failed batch row by row.
+_INSERT_ROW_SQL = {
+    "events": f"""
+        WITH u AS ({_UPSERT_USER_SQL})
+        INSERT INTO events (user_id, event_type, metadata, created_at)
+        SELECT user_id, $5::text, $6::jsonb, $7::timestamptz FROM u
+    """,
+    "attempts": f"""
+        WITH u AS ({_UPSERT_USER_SQL}),
+        a AS (
+            INSERT INTO attempts (user_id, question_id, question_num, user_answer, 
+                                correct_answer, is_correct, difficulty, topic,
+                                created_at)
+            SELECT user_id, $5::text, $6::text, $7::text, $8::text,
+                   $9::boolean, $10::text, $11::text, $12::timestamptz
+            FROM u
+            RETURNING created_at, is_correct
+        )
+        INSERT INTO attempts_hourly (hour, total, correct)
+        SELECT date_trunc('hour', created_at AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+               1, is_correct::int
+        FROM a
+        {_HOURLY_CONFLICT_SQL}
+    """,
+}
+
+# Same upsert for a whole batch of users, passed as four parallel arrays.
+_UPSERT_USERS_BULK_SQL = f"""
+    INSERT INTO users (user_id, username, first_name, last_name)
+    SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[])
+    {_USER_CONFLICT_SQL}
+"""
+
+
 async def ensure_user(user_id: int, username: Optional[str] = None, 
                      first_name: Optional[str] = None, 
                      last_name: Optional[str] = None) -> bool:
@@ -74,16 +178,7 @@ async def ensure_user(user_id: int, username: Optional[str] = None,
         
         try:
             await conn.execute(
-                """
-                INSERT INTO users (user_id, username, first_name, last_name)
-                VALUES ($1, $2, $3, $4)
-                ON CONFLICT (user_id) 
-                DO UPDATE SET 
-                    username = COALESCE(EXCLUDED.username, users.username),
-                    first_name = COALESCE(EXCLUDED.first_name, users.first_name),
-                    last_name = COALESCE(EXCLUDED.last_name, users.last_name),
-                    updated_at = NOW()
-                """,
+                _UPSERT_USER_SQL,
                 user_id, username, first_name, last_name
             )
             return True
@@ -92,21 +187,191 @@ async def ensure_user(user_id: int, username: Optional[str] = None,
             return False
 
 
-async def log_event(user_id: int, event_type: str, metadata: Optional[Dict] = None) -> bool:
-    """Log an event. Returns True if successful."""
+# Buffered writes
+
+def _start_flushers():
+    """Create write buffers and start one flush task per table."""
+    global _ATTEMPT_BUFFER, _EVENT_BUFFER
+    _ATTEMPT_BUFFER = asyncio.Queue(maxsize=BUFFER_MAXSIZE)
+    _EVENT_BUFFER = asyncio.Queue(maxsize=BUFFER_MAXSIZE)
+    _flush_tasks["attempts"] = asyncio.create_task(
+        _flush_worker(_ATTEMPT_BUFFER, "attempts", ATTEMPT_COLUMNS)
+    )
+    _flush_tasks["events"] = asyncio.create_task(
+        _flush_worker(_EVENT_BUFFER, "events", EVENT_COLUMNS)
+    )
+
+
+async def _stop_flushers():
+    """Write out everything still buffered and stop the flush tasks."""
+    global _ATTEMPT_BUFFER, _EVENT_BUFFER
+    buffers = {"attempts": _ATTEMPT_BUFFER, "events": _EVENT_BUFFER}
+    for table, task in _flush_tasks.items():
+        if not task.done():
+            await buffers[table].put(None)
+    await asyncio.gather(*_flush_tasks.values(), return_exceptions=True)
+    _flush_tasks.clear()
+
+    # Anything left over (e.g. a flush task had crashed) is written here
+    columns = {"attempts": ATTEMPT_COLUMNS, "events": EVENT_COLUMNS}
+    for table, queue in buffers.items():
+        if queue is None:
+            continue
+        batch = []
+        while not queue.empty():
+            item = queue.get_nowait()
+            if item is not None:
+                batch.append(item)
+        if batch:
+            await _copy_batch(table, columns[table], batch)
+
+    _ATTEMPT_BUFFER = None
+    _EVENT_BUFFER = None
+
+
+def _buffer_alive(table: str) -> bool:
+    """True if the flush task for `table` is running."""
+    task = _flush_tasks.get(table)
+    return task is not None and not task.done()
+
+
+async def _flush_worker(queue: asyncio.Queue, table: str, columns: List[str]):
+    """Drain `queue` in batches of up to FLUSH_BATCH_SIZE or FLUSH_INTERVAL seconds.
+
+    A None item is the stop signal: the current batch is written and the task exits.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        batch = [item]
+        stop = False
+        deadline = loop.time() + FLUSH_INTERVAL
+        while len(batch) < FLUSH_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+
+        await _copy_batch(table, columns, batch)
+        if stop:
+            return
+
+
+async def _copy_batch(table: str, columns: List[str], batch: List[Tuple[Tuple, Tuple]]) -> bool:
+    """Upsert the batch's users and COPY its rows into `table` in one transaction.
+
+    If a row's data breaks the batch, its rows are written one by one instead;
+    on any other error the batch is dropped so the flush task does not stall.
+    """
+    users: Dict[int, Tuple] = {}
+    for user, _ in batch:
+        prev = users.get(user[0])
+        if prev:
+            user = tuple(new if new is not None else old for new, old in zip(user, prev))
+        users[user[0]] = user
+
+    # Both flush tasks lock users rows; upserting them in user_id order keeps
+    # concurrent batches from deadlocking on each other.
+    user_columns = [list(col) for col in zip(*(users[uid] for uid in sorted(users)))]
+
+    async with get_conn() as conn:
+        if not conn:
+            return False
+
+        for attempt in range(1, FLUSH_DEADLOCK_RETRIES + 1):
+            try:
+                async with conn.transaction():
+                    await conn.execute(_UPSERT_USERS_BULK_SQL, *user_columns)
+                    await conn.copy_records_to_table(
+                        table, records=[row for _, row in batch], columns=columns
+                    )
+                    if table == "attempts":
+                        await conn.execute(_ADD_HOURLY_BULK_SQL, *_hourly_counts(batch))
+                return True
+            except asyncpg.DeadlockDetectedError as e:
+                if attempt == FLUSH_DEADLOCK_RETRIES:
+                    logger.error(f"Error flushing {len(batch)} rows into {table}, dropped: {e}")
+                    return False
+                logger.warning(f"Deadlock flushing {table}, retrying ({attempt}): {e}")
+            except _ROW_ERRORS as e:
+                logger.error(f"Error flushing {len(batch)} rows into {table}: {e}")
+                return await _write_rows(conn, table, batch)
+            except Exception as e:
+                logger.error(f"Error flushing {len(batch)} rows into {table}, dropped: {e}")
+                return False
+        return False
+
+
+async def _write_rows(conn, table: str, batch: List[Tuple[Tuple, Tuple]]) -> bool:
+    """Write a failed batch row by row, so a bad row only loses itself."""
+    written = 0
+    for user, row in batch:
+        try:
+            await conn.execute(_INSERT_ROW_SQL[table], *user, *row[1:])
+            written += 1
+        except _ROW_ERRORS as e:
+            logger.error(f"Error writing {table} row for user {user[0]}: {e}")
+        except Exception as e:
+            logger.error(f"Error writing {table} rows one by one, stopped: {e}")
+            break
+    if written < len(batch):
+        logger.error(f"Dropped {len(batch) - written} of {len(batch)} rows for {table}")
+    return written == len(batch)
+
+
+def _hourly_counts(batch: List[Tuple[Tuple, Tuple]]) -> Tuple[List, List, List]:
+    """Group buffered attempt rows by UTC hour into (hours, totals, corrects)."""
+    counts: Dict[datetime, List[int]] = {}
+    for _, row in batch:
+        hour = row[-1].replace(minute=0, second=0, microsecond=0)
+        bucket = counts.setdefault(hour, [0, 0])
+        bucket[0] += 1
+        bucket[1] += int(row[5])
+    return (
+        list(counts),
+        [total for total, _ in counts.values()],
+        [correct for _, correct in counts.values()],
+    )
+
+
+async def log_event(user_id: int, event_type: str, metadata: Optional[Dict] = None,
+                    username: Optional[str] = None,
+                    first_name: Optional[str] = None,
+                    last_name: Optional[str] = None) -> bool:
+    """Log an event. Returns True if it was buffered or written.
+
+    The row is queued for the batch writer without waiting (dropped if the
+    buffer is full); if the writer is not running, it is written directly,
+    upserting the user in the same statement.
+    """
+    if not _pool:
+        return False
+
+    user = (user_id, username, first_name, last_name)
+    row = (user_id, event_type, json.dumps(metadata or {}), datetime.now(timezone.utc))
+    if _buffer_alive("events"):
+        try:
+            _EVENT_BUFFER.put_nowait((user, row))
+        except asyncio.QueueFull:
+            logger.warning(f"Event buffer full, dropped event for user {user_id}")
+            return False
+        return True
+
     async with get_conn() as conn:
         if not conn:
             return False
         
         try:
-            await ensure_user(user_id)
-            await conn.execute(
-                """
-                INSERT INTO events (user_id, event_type, metadata)
-                VALUES ($1, $2, $3)
-                """,
-                user_id, event_type, metadata or {}
-            )
+            await conn.execute(_INSERT_ROW_SQL["events"], *user, *row[1:])
             return True
         except Exception as e:
             logger.error(f"Error logging event {event_type} for user {user_id}: {e}")
@@ -115,23 +380,36 @@ async def log_event(user_id: int, event_type: str, metadata: Optional[Dict] = No
 
 async def log_attempt(user_id: int, question_id: str, question_num: Optional[str],
                      user_answer: str, correct_answer: str, is_correct: bool,
-                     difficulty: Optional[str] = None, topic: Optional[str] = None) -> bool:
-    """Log a question attempt. Returns True if successful."""
+                     difficulty: Optional[str] = None, topic: Optional[str] = None,
+                     username: Optional[str] = None,
+                     first_name: Optional[str] = None,
+                     last_name: Optional[str] = None) -> bool:
+    """Log a question attempt. Returns True if it was buffered or written.
+
+    The row is queued for the batch writer without waiting (dropped if the
+    buffer is full); if the writer is not running, it is written directly,
+    upserting the user in the same statement.
+    """
+    if not _pool:
+        return False
+
+    user = (user_id, username, first_name, last_name)
+    row = (user_id, question_id, question_num, user_answer, correct_answer,
+           is_correct, difficulty, topic, datetime.now(timezone.utc))
+    if _buffer_alive("attempts"):
+        try:
+            _ATTEMPT_BUFFER.put_nowait((user, row))
+        except asyncio.QueueFull:
+            logger.warning(f"Attempt buffer full, dropped attempt for user {user_id}")
+            return False
+        return True
+
     async with get_conn() as conn:
         if not conn:
             return False
         
         try:
-            await ensure_user(user_id)
-            await conn.execute(
-                """
-                INSERT INTO attempts (user_id, question_id, question_num, user_answer, 
-                                    correct_answer, is_correct, difficulty, topic)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
-                """,
-                user_id, question_id, question_num, user_answer, 
-                correct_answer, is_correct, difficulty, topic
-            )
+            await conn.execute(_INSERT_ROW_SQL["attempts"], *user, *row[1:])
             return True
         except Exception as e:
             logger.error(f"Error logging attempt for user {user_id}: {e}")
@@ -140,187 +418,256 @@ async def log_attempt(user_id: int, question_id: str, question_num: Optional[str
 
 # Analytics queries
 
+# Start of the current local day as a UTC timestamptz, for a UTC offset in
+# hours passed as $1. Computed server-side so the query text stays constant
+# and asyncpg reuses its prepared statement for every offset.
+_LOCAL_DAY_START_SQL = """(
+    date_trunc('day', NOW() AT TIME ZONE 'UTC' + make_interval(hours => $1::int))
+    - make_interval(hours => $1::int)
+) AT TIME ZONE 'UTC'"""
+
+
+class _Uncached:
+    """A fallback result that ttl_cache returns but does not store."""
+    __slots__ = ("value",)
+
+    def __init__(self, value: Any):
+        self.value = value
+
+
+def ttl_cache(seconds: float = ANALYTICS_CACHE_TTL):
+    """Cache an analytics coroutine's result per arguments for `seconds`.
+
+    Fallback results wrapped in _Uncached (no DB, failed query) are returned
+    unwrapped and not cached, so the next call retries the query.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = (func.__name__, args, tuple(sorted(kwargs.items())))
+            now = time.monotonic()
+            cached = _CACHE.get(key)
+            if cached and now - cached[0] < seconds:
+                return cached[1]
+
+            result = await func(*args, **kwargs)
+            if isinstance(result, _Uncached):
+                return result.value
+            _CACHE[key] = (now, result)
+            return result
+        return wrapper
+    return decorator
+
+
+@ttl_cache()
 async def get_dau_today(timezone_offset: int = 6) -> int:
     """Get Daily Active Users for today (UTC+6)."""
     async with get_conn() as conn:
         if not conn:
-            return 0
+            return _Uncached(0)
         
         try:
-            # Calculate start of day in UTC+6
-            now = datetime.utcnow()
-            tz_offset = timedelta(hours=timezone_offset)
-            local_now = now + tz_offset
-            start_of_day = local_now.replace(hour=0, minute=0, second=0, microsecond=0)
-            start_of_day_utc = start_of_day - tz_offset
-            
             count = await conn.fetchval(
-                """
+                f"""
                 SELECT COUNT(DISTINCT user_id)
                 FROM events
-                WHERE created_at >= $1
+                WHERE created_at >= {_LOCAL_DAY_START_SQL}
                 """,
-                start_of_day_utc
+                timezone_offset
             )
             return count or 0
         except Exception as e:
             logger.error(f"Error getting DAU: {e}")
-            return 0
+            return _Uncached(0)
 
 
+@ttl_cache()
 async def get_attempts_today(timezone_offset: int = 6) -> int:
     """Get attempts count for today (UTC+6)."""
     async with get_conn() as conn:
         if not conn:
-            return 0
+            return _Uncached(0)
         
         try:
-            now = datetime.utcnow()
-            tz_offset = timedelta(hours=timezone_offset)
-            local_now = now + tz_offset
-            start_of_day = local_now.replace(hour=0, minute=0, second=0, microsecond=0)
-            start_of_day_utc = start_of_day - tz_offset
-            
             count = await conn.fetchval(
-                """
-                SELECT COUNT(*)
-                FROM attempts
-                WHERE created_at >= $1
+                f"""
+                SELECT SUM(total)
+                FROM attempts_hourly
+                WHERE hour >= {_LOCAL_DAY_START_SQL}
                 """,
-                start_of_day_utc
+                timezone_offset
             )
             return count or 0
         except Exception as e:
             logger.error(f"Error getting attempts today: {e}")
-            return 0
+            return _Uncached(0)
 
 
+@ttl_cache()
 async def get_attempts_total() -> int:
     """Get total attempts count (all-time)."""
     async with get_conn() as conn:
         if not conn:
-            return 0
+            return _Uncached(0)
         
         try:
-            count = await conn.fetchval("SELECT COUNT(*) FROM attempts")
+            count = await conn.fetchval("SELECT SUM(total) FROM attempts_hourly")
             return count or 0
         except Exception as e:
             logger.error(f"Error getting total attempts: {e}")
-            return 0
+            return _Uncached(0)
 
 
+@ttl_cache()
 async def get_accuracy() -> float:
     """Get overall accuracy (correct / total)."""
     async with get_conn() as conn:
         if not conn:
-            return 0.0
+            return _Uncached(0.0)
         
         try:
             result = await conn.fetchrow(
                 """
                 SELECT 
-                    COUNT(*) as total,
-                    SUM(CASE WHEN is_correct THEN 1 ELSE 0 END) as correct
-                FROM attempts
+                    SUM(total) as total,
+                    SUM(correct) as correct
+                FROM attempts_hourly
                 """
             )
-            if result and result['total'] > 0:
+            if result and result['total']:
                 return (result['correct'] / result['total']) * 100
             return 0.0
         except Exception as e:
             logger.error(f"Error getting accuracy: {e}")
-            return 0.0
+            return _Uncached(0.0)
+
+
+@dataclass
+class TodaySnapshot:
+    """Headline numbers for the admin dashboard."""
+    dau: int = 0
+    attempts_today: int = 0
+    attempts_total: int = 0
+    accuracy: float = 0.0
+
+
+@ttl_cache()
+async def get_today_snapshot(timezone_offset: int = 6) -> TodaySnapshot:
+    """Get DAU, attempts today/total and accuracy (UTC+6) in one query."""
+    async with get_conn() as conn:
+        if not conn:
+            return _Uncached(TodaySnapshot())
+        
+        try:
+            result = await conn.fetchrow(
+                f"""
+                WITH d AS (SELECT {_LOCAL_DAY_START_SQL} as start)
+                SELECT 
+                    (SELECT COUNT(DISTINCT user_id)
+                     FROM events, d
+                     WHERE created_at >= d.start) as dau,
+                    SUM(total) FILTER (WHERE hour >= d.start) as attempts_today,
+                    SUM(total) as total,
+                    SUM(correct) as correct
+                FROM attempts_hourly, d
+                """,
+                timezone_offset
+            )
+            if not result:
+                return TodaySnapshot()
 
+            total = result['total'] or 0
+            return TodaySnapshot(
+                dau=result['dau'] or 0,
+                attempts_today=result['attempts_today'] or 0,
+                attempts_total=total,
+                accuracy=(result['correct'] / total) * 100 if total else 0.0,
+            )
+        except Exception as e:
+            logger.error(f"Error getting today snapshot: {e}")
+            return _Uncached(TodaySnapshot())
 
+
+@ttl_cache()
 async def get_attempts_per_day(days: int = 14, timezone_offset: int = 6) -> List[Tuple[str, int]]:
     """Get attempts per day for last N days. Returns list of (date, count) tuples."""
     async with get_conn() as conn:
         if not conn:
-            return []
+            return _Uncached([])
         
         try:
-            now = datetime.utcnow()
-            tz_offset = timedelta(hours=timezone_offset)
-            local_now = now + tz_offset
-            start_date = local_now - timedelta(days=days)
-            start_date_utc = start_date - tz_offset
-            
             rows = await conn.fetch(
-                f"""
+                """
                 SELECT 
-                    DATE(created_at + INTERVAL '{timezone_offset} hours') as date,
-                    COUNT(*) as count
-                FROM attempts
-                WHERE created_at >= $1
-                GROUP BY DATE(created_at + INTERVAL '{timezone_offset} hours')
+                    DATE(hour AT TIME ZONE 'UTC' + make_interval(hours => $1::int)) as date,
+                    SUM(total) as count
+                FROM attempts_hourly
+                WHERE hour >= NOW() - make_interval(days => $2::int)
+                GROUP BY 1
                 ORDER BY date DESC
                 """,
-                start_date_utc
+                timezone_offset, days
             )
             
             return [(row['date'].strftime('%Y-%m-%d'), row['count']) for row in rows]
         except Exception as e:
             logger.error(f"Error getting attempts per day: {e}")
-            return []
+            return _Uncached([])
 
 
+@ttl_cache()
 async def get_top_users_last_7_days(limit: int = 10, timezone_offset: int = 6) -> List[Tuple[int, int]]:
     """Get top users by solved questions in last 7 days. Returns list of (user_id, count) tuples."""
     async with get_conn() as conn:
         if not conn:
-            return []
+            return _Uncached([])
         
         try:
-            now = datetime.utcnow()
-            tz_offset = timedelta(hours=timezone_offset)
-            local_now = now + tz_offset
-            start_date = local_now - timedelta(days=7)
-            start_date_utc = start_date - tz_offset
-            
+            # A rolling 7-day window is the same in every timezone
             rows = await conn.fetch(
                 """
                 SELECT user_id, COUNT(*) as count
                 FROM attempts
-                WHERE created_at >= $1 AND is_correct = true
+                WHERE created_at >= NOW() - INTERVAL '7 days' AND is_correct = true
                 GROUP BY user_id
                 ORDER BY count DESC
-                LIMIT $2
+                LIMIT $1
                 """,
-                start_date_utc, limit
+                limit
             )
             
             return [(row['user_id'], row['count']) for row in rows]
         except Exception as e:
             logger.error(f"Error getting top users: {e}")
-            return []
+            return _Uncached([])
 
 
+@ttl_cache()
 async def get_retention_d1() -> float:
     """Get D1 retention: % of users who returned the next day."""
     async with get_conn() as conn:
         if not conn:
-            return 0.0
+            return _Uncached(0.0)
         
         try:
             result = await conn.fetchrow(
                 """
-                WITH first_visits AS (
-                    SELECT user_id, DATE(MIN(created_at)) as first_date
-                    FROM events
-                    WHERE event_type = 'user_start'
-                    GROUP BY user_id
-                ),
-                returned_users AS (
-                    SELECT DISTINCT fv.user_id
-                    FROM first_visits fv
-                    INNER JOIN events e ON e.user_id = fv.user_id
-                    WHERE DATE(e.created_at) = fv.first_date + INTERVAL '1 day'
-                )
                 SELECT 
-                    COUNT(DISTINCT fv.user_id) as total_users,
-                    COUNT(DISTINCT ru.user_id) as returned_users
-                FROM first_visits fv
-                LEFT JOIN returned_users ru ON ru.user_id = fv.user_id
+                    COUNT(*) as total_users,
+                    COUNT(*) FILTER (WHERE returned) as returned_users
+                FROM (
+                    SELECT user_id, BOOL_OR(day = first_date + 1) as returned
+                    FROM (
+                        SELECT 
+                            user_id,
+                            DATE(created_at) as day,
+                            MIN(DATE(created_at)) FILTER (WHERE event_type = 'user_start')
+                                OVER (PARTITION BY user_id) as first_date
+                        FROM events
+                    ) e
+                    WHERE first_date IS NOT NULL
+                    GROUP BY user_id
+                ) t
                 """
             )
             
@@ -329,5 +676,5 @@ async def get_retention_d1() -> float:
             return 0.0
         except Exception as e:
             logger.error(f"Error getting retention D1: {e}")
-            return 0.0
+            return _Uncached(0.0)
 
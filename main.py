@@ -1,26 +1,24 @@
-import asyncio
-import json
+from bisect import bisect_left
+from functools import lru_cache
 from pathlib import Path
 import os
 import random
-import asyncio
 
-from fastapi import FastAPI
-app = FastAPI()
-
-@app.get("/")
-def health():
-    return {"status": "ok"}
 from aiogram import Bot, Dispatcher, Router, F
-from aiogram.filters import CommandStart
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject, CommandStart
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import (
     Message,
     CallbackQuery,
-    FSInputFile
+    FSInputFile,
+    InlineKeyboardMarkup
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from dotenv import load_dotenv
+import orjson
 import db
+import state
 
 # -------------------------------------
 # LOAD TOKEN (deferred - don't fail at import time)
@@ -44,91 +42,133 @@ QUESTIONS_FILE = BASE_DIR / "questions.json"
 # DATA STRUCTURES
 # -------------------------------------
 router = Router()
-QUESTIONS = []
-ORDERED_QUESTIONS = []
-QUESTION_INDEX = {}   # "1" -> question object
-USER_PROGRESS = {}    # user_id -> {"difficulty":, "index":}
-SEEN_USERS = set()    # user_ids that already received intro
 
-USER_STATS = {}       # user_id -> stats dict
 
-TOPIC_INDEX = {}      # topic_name -> [qnum strings]
-TOPIC_NAME_MAP = {}   # lowercased topic -> canonical topic
+# Callback data of inline buttons, packed as "prefix:field:field"
+class AnswerCallback(CallbackData, prefix="ans"):
+    qid: str
+    letter: str
+    nav: str          # "manual" | "sequential" | "review"
 
 
-# -------------------------------------
-# HELPERS: STATS
-# -------------------------------------
-def get_user_stats(user_id: int):
-    if user_id not in USER_STATS:
-        USER_STATS[user_id] = {
-            "total": 0,
-            "correct": 0,
-            "by_diff": {},      # diff -> {"total":, "correct":}
-            "wrong_qnums": set()
-        }
-    return USER_STATS[user_id]
+class NavCallback(CallbackData, prefix="nav"):
+    step: int         # -1 previous, +1 next
+    qnum: int
 
 
-def update_stats(user_id: int, question: dict, qnum: str, is_correct: bool):
-    stats = get_user_stats(user_id)
+class LevelCallback(CallbackData, prefix="level"):
+    difficulty: str
 
-    stats["total"] += 1
-    if is_correct:
-        stats["correct"] += 1
 
-    diff = question.get("difficulty", "unknown")
-    by_diff = stats["by_diff"].setdefault(diff, {"total": 0, "correct": 0})
-    by_diff["total"] += 1
-    if is_correct:
-        by_diff["correct"] += 1
+QUESTIONS = []        # raw question objects, in file order
 
-    # wrong questions set
-    if is_correct:
-        stats["wrong_qnums"].discard(qnum)
-    else:
-        stats["wrong_qnums"].add(qnum)
+# Question fields as parallel lists: question number qnum (1-based int)
+# lives at index qnum - 1 in each of them
+Q_ID = []
+Q_TEXT = []
+Q_OPTIONS = []        # {"A": text, ...}
+Q_ANSWER = []
+Q_EXPLANATION = []
+Q_DIFF = []
+Q_TOPIC = []
+Q_IMAGE = []          # resolved image Path or None
+
+IMG_CACHE = {}        # question id -> Telegram file_id of its uploaded image
+
+DIFF_INDEX = {}       # difficulty -> [qnum ints]
+ID_TO_QNUM = {}       # question id -> qnum
+
+TOPIC_INDEX = {}      # topic_name -> [qnum ints]
+TOPIC_NAME_MAP = {}   # lowercased topic -> canonical topic
+TOPIC_NAMES = []      # sorted lowercased topics, for prefix search
 
 
 # -------------------------------------
 # LOAD QUESTIONS & TOPICS
 # -------------------------------------
 def load_questions():
-    global QUESTIONS, ORDERED_QUESTIONS, QUESTION_INDEX, TOPIC_INDEX, TOPIC_NAME_MAP
-
-    with open(QUESTIONS_FILE, "r", encoding="utf-8") as f:
-        QUESTIONS = json.load(f)
-
-    ORDERED_QUESTIONS = QUESTIONS[:]
-    QUESTION_INDEX = {str(i + 1): q for i, q in enumerate(ORDERED_QUESTIONS)}
-
-    # Build topics index
+    global QUESTIONS, Q_ID, Q_TEXT, Q_OPTIONS, Q_ANSWER, Q_EXPLANATION
+    global Q_DIFF, Q_TOPIC, Q_IMAGE, DIFF_INDEX, ID_TO_QNUM
+    global TOPIC_INDEX, TOPIC_NAME_MAP, TOPIC_NAMES
+
+    with open(QUESTIONS_FILE, "rb") as f:
+        QUESTIONS = orjson.loads(f.read())
+
+    Q_ID = [q["id"] for q in QUESTIONS]
+    Q_TEXT = [q.get("question_kg") or q.get("text") or "Суроо жок" for q in QUESTIONS]
+    Q_OPTIONS = [q["options"] for q in QUESTIONS]
+    Q_ANSWER = [q.get("answer") or q.get("correct") for q in QUESTIONS]
+    Q_EXPLANATION = [q.get("explanation_kg") or q.get("explanation") or "" for q in QUESTIONS]
+    Q_DIFF = [q.get("difficulty") for q in QUESTIONS]
+    Q_TOPIC = [str(q["topic"]) if q.get("topic") else None for q in QUESTIONS]
+    Q_IMAGE = [resolve_image(q.get("image")) for q in QUESTIONS]
+    ID_TO_QNUM = {qid: i + 1 for i, qid in enumerate(Q_ID)}
+
+    # Difficulty and topics indexes
+    DIFF_INDEX = {}
     TOPIC_INDEX = {}
-    for qnum, q in QUESTION_INDEX.items():
-        topic = q.get("topic")
+    for qnum, (diff, topic) in enumerate(zip(Q_DIFF, Q_TOPIC), start=1):
+        DIFF_INDEX.setdefault(diff, []).append(qnum)
         if topic:
-            topic_str = str(topic)
-            TOPIC_INDEX.setdefault(topic_str, []).append(qnum)
+            TOPIC_INDEX.setdefault(topic, []).append(qnum)
 
     # lowercased name map
     TOPIC_NAME_MAP = {topic.lower(): topic for topic in TOPIC_INDEX.keys()}
+    TOPIC_NAMES = sorted(TOPIC_NAME_MAP)
+
+
+def resolve_image(image_path):
+    """Absolute path of a question image, or None if it is not set or missing."""
+    if not image_path:
+        return None
+    img_file = BASE_DIR / image_path
+    return img_file if img_file.exists() else None
+
+
+def question_exists(qnum: int) -> bool:
+    return 1 <= qnum <= len(Q_ID)
 
 
 def get_questions_by_difficulty(difficulty: str):
-    return [q for q in QUESTIONS if q.get("difficulty") == difficulty]
+    """qnums of all questions with this difficulty, in order."""
+    return DIFF_INDEX.get(difficulty, [])
 
 
 # -------------------------------------
 # SEND ANY QUESTION (universal)
 # -------------------------------------
-async def send_question_universal(bot, user_id, q, qnum, nav_mode="manual"):
-    question_text = q.get("question_kg") or q.get("text") or "Суроо жок"
+@lru_cache(maxsize=4096)
+def build_markup(qid: str, qnum: int, letters: tuple, nav_mode: str) -> InlineKeyboardMarkup:
+    # Pure function of its arguments, so repeat sends reuse the same markup
+    kb = InlineKeyboardBuilder()
+
+    # Answer buttons
+    for letter in letters:
+        kb.button(
+            text=letter,
+            callback_data=AnswerCallback(qid=qid, letter=letter, nav=nav_mode)
+        )
+
+    # Navigation buttons (global prev/next)
+    kb.button(text="⬅️ Previous", callback_data=NavCallback(step=-1, qnum=qnum))
+    kb.button(text="➡️ Next", callback_data=NavCallback(step=1, qnum=qnum))
+
+    # First row: answers (A–D), second row: Prev/Next
+    kb.adjust(4, 2)
+    return kb.as_markup()
+
+
+async def send_question_universal(bot, user_id, qnum, nav_mode="manual"):
+    i = qnum - 1
+    qid = Q_ID[i]
+    options = Q_OPTIONS[i]
+    question_text = Q_TEXT[i]
 
     options_block = "\n".join(
-        f"{letter}) {text}" for letter, text in q["options"].items()
+        f"{letter}) {text}" for letter, text in options.items()
     )
 
-    header = f"Суроо {qnum} / {len(ORDERED_QUESTIONS)}"
+    header = f"Суроо {qnum} / {len(Q_ID)}"
 
     msg = (
         f"{header}\n"
@@ -137,80 +177,73 @@ async def send_question_universal(bot, user_id, q, qnum, nav_mode="manual"):
         f"Жооп варианттары:\n{options_block}"
     )
 
-    kb = InlineKeyboardBuilder()
-
-    # Answer buttons
-    for letter in q["options"].keys():
-        kb.button(
-            text=letter,
-            callback_data=f"answer|{q['id']}|{letter}|{nav_mode}|{qnum}"
-        )
-
-    # Navigation buttons (global prev/next)
-    kb.button(text="⬅️ Previous", callback_data=f"nav_prev|{qnum}")
-    kb.button(text="➡️ Next", callback_data=f"nav_next|{qnum}")
-
-    # First row: answers (A–D), second row: Prev/Next
-    kb.adjust(4, 2)
+    markup = build_markup(qid, qnum, tuple(options), nav_mode)
 
     # Log question_sent event
     await db.log_event(
         user_id,
         "question_sent",
-        {"question_id": q.get("id"), "question_num": qnum, "nav_mode": nav_mode}
+        {"question_id": qid, "question_num": str(qnum), "nav_mode": nav_mode}
     )
 
-    # With image
-    image_path = q.get("image")
-    if image_path:
-        img_file = BASE_DIR / image_path
-        if img_file.exists():
-            await bot.send_photo(
-                chat_id=user_id,
-                photo=FSInputFile(img_file),
-                caption=msg,
-                reply_markup=kb.as_markup(),
-            )
-            return
+    # With image: upload once, then reuse Telegram's file_id
+    img_file = Q_IMAGE[i]
+    if img_file:
+        file_id = IMG_CACHE.get(qid)
+        if file_id:
+            try:
+                await bot.send_photo(
+                    chat_id=user_id,
+                    photo=file_id,
+                    caption=msg,
+                    reply_markup=markup,
+                )
+                return
+            except TelegramBadRequest:
+                # file_id no longer valid, upload again
+                IMG_CACHE.pop(qid, None)
+
+        sent = await bot.send_photo(
+            chat_id=user_id,
+            photo=FSInputFile(img_file),
+            caption=msg,
+            reply_markup=markup,
+        )
+        if sent.photo:
+            IMG_CACHE[qid] = sent.photo[-1].file_id
+        return
 
     # Without image
     await bot.send_message(
         user_id,
         msg,
-        reply_markup=kb.as_markup()
+        reply_markup=markup
     )
 
 
 # -------------------------------------
 # SEND SEQUENTIAL QUESTION (by difficulty)
 # -------------------------------------
-async def send_sequential(bot, user_id, difficulty):
-    questions = get_questions_by_difficulty(difficulty)
-    if not questions:
+async def send_sequential(bot, user_id, difficulty, idx=None):
+    # idx is passed by callers that just stored the progress themselves
+    qnums = get_questions_by_difficulty(difficulty)
+    if not qnums:
         await bot.send_message(user_id, "Бул деңгээлде суроолор жок.")
         return
 
-    progress = USER_PROGRESS.get(user_id)
-    if not progress or progress["difficulty"] != difficulty:
-        progress = {"difficulty": difficulty, "index": 0}
-        USER_PROGRESS[user_id] = progress
+    if idx is None:
+        progress = await state.get_progress(user_id)
+        if progress and progress["difficulty"] == difficulty:
+            idx = progress["index"]
+        else:
+            idx = 0
+            await state.set_progress(user_id, difficulty, idx)
 
-    idx = progress["index"]
-
-    if idx >= len(questions):
+    if idx >= len(qnums):
         await bot.send_message(user_id, "Бул деңгээлдеги бардык суроолорду бүттүң.")
         return
 
-    q = questions[idx]
-
-    # Find global qnum
-    qnum = None
-    for num, obj in QUESTION_INDEX.items():
-        if obj["id"] == q["id"]:
-            qnum = num
-            break
-
-    await send_question_universal(bot, user_id, q, qnum, nav_mode="sequential")
+    await send_question_universal(bot, user_id, qnums[idx], nav_mode="sequential")
 
 
 # -------------------------------------
@@ -219,9 +252,9 @@ async def send_sequential(bot, user_id, difficulty):
 async def send_intro(message: Message):
     kb = InlineKeyboardBuilder()
     # Difficulty buttons
-    kb.button(text="Жеңил", callback_data="level|easy")
-    kb.button(text="Орточо", callback_data="level|medium")
-    kb.button(text="Кыйын", callback_data="level|hard")
+    kb.button(text="Жеңил", callback_data=LevelCallback(difficulty="easy"))
+    kb.button(text="Орточо", callback_data=LevelCallback(difficulty="medium"))
+    kb.button(text="Кыйын", callback_data=LevelCallback(difficulty="hard"))
     # Extra onboarding (only random + help, NO topics button)
     kb.button(text="🎲 Random суроо", callback_data="intro_random")
     kb.button(text="ℹ️ Командалар", callback_data="intro_help")
@@ -247,16 +280,16 @@ async def send_intro(message: Message):
 @router.message(CommandStart())
 async def start_handler(message: Message):
     user_id = message.from_user.id
-    SEEN_USERS.add(user_id)
+    await state.mark_seen(user_id)
     
-    # Log user_start event
-    await db.ensure_user(
+    # Log user_start event (also creates/updates the user)
+    await db.log_event(
         user_id,
+        "user_start",
         username=message.from_user.username,
         first_name=message.from_user.first_name,
         last_name=message.from_user.last_name
     )
-    await db.log_event(user_id, "user_start")
     
     await send_intro(message)
 
@@ -264,14 +297,14 @@ async def start_handler(message: Message):
 # -------------------------------------
 # LEVEL SELECTOR
 # -------------------------------------
-@router.callback_query(F.data.startswith("level|"))
-async def level_handler(callback: CallbackQuery, bot: Bot):
-    _, difficulty = callback.data.split("|")
+@router.callback_query(LevelCallback.filter())
+async def level_handler(callback: CallbackQuery, callback_data: LevelCallback, bot: Bot):
+    difficulty = callback_data.difficulty
 
-    USER_PROGRESS[callback.from_user.id] = {"difficulty": difficulty, "index": 0}
+    await state.set_progress(callback.from_user.id, difficulty, 0)
 
     await callback.message.answer(f"Тандалды: {difficulty}\nМына биринчи суроо:")
-    await send_sequential(bot, callback.from_user.id, difficulty)
+    await send_sequential(bot, callback.from_user.id, difficulty, idx=0)
     await callback.answer()
 
 
@@ -280,9 +313,8 @@ async def level_handler(callback: CallbackQuery, bot: Bot):
 # -------------------------------------
 @router.callback_query(F.data == "intro_random")
 async def intro_random(callback: CallbackQuery, bot: Bot):
-    qnum = str(random.randint(1, len(ORDERED_QUESTIONS)))
-    q = QUESTION_INDEX[qnum]
-    await send_question_universal(bot, callback.from_user.id, q, qnum, nav_mode="manual")
+    qnum = random.randint(1, len(Q_ID))
+    await send_question_universal(bot, callback.from_user.id, qnum, nav_mode="manual")
     await callback.answer()
 
 
@@ -305,75 +337,62 @@ async def intro_help(callback: CallbackQuery):
 # -------------------------------------
 # /goto N
 # -------------------------------------
-@router.message(F.text.startswith("/goto"))
-async def goto_handler(message: Message):
-    parts = message.text.split()
-    if len(parts) != 2 or not parts[1].isdigit():
+@router.message(Command("goto"))
+async def goto_handler(message: Message, command: CommandObject):
+    arg = (command.args or "").strip()
+    if not arg.isdecimal():
         await message.answer("Туура формат: /goto 59")
         return
 
-    qnum = parts[1]
+    qnum = int(arg)
 
-    if qnum not in QUESTION_INDEX:
+    if not question_exists(qnum):
         await message.answer("Бул номердеги суроо жок.")
         return
 
-    q = QUESTION_INDEX[qnum]
     await send_question_universal(
-        message.bot, message.from_user.id, q, qnum, nav_mode="manual"
+        message.bot, message.from_user.id, qnum, nav_mode="manual"
     )
 
 
 # -------------------------------------
 # /random
 # -------------------------------------
-@router.message(F.text == "/random")
 async def random_handler(message: Message):
-    qnum = str(random.randint(1, len(ORDERED_QUESTIONS)))
-    q = QUESTION_INDEX[qnum]
+    qnum = random.randint(1, len(Q_ID))
     await send_question_universal(
-        message.bot, message.from_user.id, q, qnum, nav_mode="manual"
+        message.bot, message.from_user.id, qnum, nav_mode="manual"
     )
 
 
 # -------------------------------------
 # /stats
 # -------------------------------------
-@router.message(F.text == "/stats")
 async def stats_handler(message: Message):
     user_id = message.from_user.id
-    stats = USER_STATS.get(user_id)
+    stats = await state.get_user_stats(user_id)
 
-    if not stats or stats["total"] == 0:
+    if not stats or stats.total == 0:
         await message.answer("Азырынча статистика жок. Адегенде суроолорду чеч.")
         return
 
-    total = stats["total"]
-    correct = stats["correct"]
-    acc = (correct / total) * 100 if total > 0 else 0.0
-
     lines = [
         "📊 Сенин статистикаң:",
-        f"Бардык суроолор: {total}",
-        f"Туура жооптор: {correct} ({acc:.1f}%)",
+        f"Бардык суроолор: {stats.total}",
+        f"Туура жооптор: {stats.correct} ({stats.acc_pct:.1f}%)",
         ""
     ]
 
-    if stats["by_diff"]:
+    if stats.by_diff:
         lines.append("Деңгээл боюнча:")
-        for diff, d in stats["by_diff"].items():
-            t = d["total"]
-            c = d["correct"]
-            a = (c / t) * 100 if t > 0 else 0.0
-            lines.append(f"• {diff}: {c}/{t} ({a:.1f}%)")
+        for diff, d in stats.by_diff.items():
+            lines.append(f"• {diff}: {d['correct']}/{d['total']} ({d['pct']:.1f}%)")
     else:
         lines.append("Деңгээл боюнча маалымат жок.")
 
-    wrong_count = len(stats["wrong_qnums"])
-    lines.append(f"\nКайталай турган суроолор (wrong): {wrong_count}")
-    if wrong_count > 0:
-        sample = list(stats["wrong_qnums"])[:10]
-        lines.append("Мисалы: " + ", ".join(sample))
+    lines.append(f"\nКайталай турган суроолор (wrong): {stats.wrong_count}")
+    if stats.wrong_recent:
+        lines.append("Мисалы: " + ", ".join(map(str, stats.wrong_recent)))
 
     await message.answer("\n".join(lines))
 
@@ -381,26 +400,22 @@ async def stats_handler(message: Message):
 # -------------------------------------
 # /review_wrong
 # -------------------------------------
-@router.message(F.text == "/review_wrong")
 async def review_wrong_handler(message: Message):
     user_id = message.from_user.id
-    stats = USER_STATS.get(user_id)
+    qnum = await state.random_wrong(user_id)
 
-    if not stats or not stats["wrong_qnums"]:
+    if qnum is None:
         await message.answer("Азырынча ката суроолор жок же баарын оңдогонсүң. 👌")
         return
 
-    qnum = random.choice(list(stats["wrong_qnums"]))
-    q = QUESTION_INDEX[qnum]
     await send_question_universal(
-        message.bot, user_id, q, qnum, nav_mode="review"
+        message.bot, user_id, qnum, nav_mode="review"
     )
 
 
 # -------------------------------------
 # /topics
 # -------------------------------------
-@router.message(F.text == "/topics")
 async def topics_handler(message: Message):
     if not TOPIC_INDEX:
         await message.answer("Азырынча темалар белгиленген эмес.")
@@ -421,23 +436,22 @@ async def topics_handler(message: Message):
 # -------------------------------------
 # /topic <name>
 # -------------------------------------
-@router.message(F.text.startswith("/topic"))
-async def topic_handler(message: Message):
-    parts = message.text.split(maxsplit=1)
-    if len(parts) != 2:
+@router.message(Command("topic"))
+async def topic_handler(message: Message, command: CommandObject):
+    if not command.args or not command.args.strip():
         await message.answer("Туура формат: /topic Algebra")
         return
 
-    query = parts[1].strip().lower()
+    query = command.args.strip().lower()
     topic_canonical = None
 
     if query in TOPIC_NAME_MAP:
         topic_canonical = TOPIC_NAME_MAP[query]
     else:
-        for low, canon in TOPIC_NAME_MAP.items():
-            if low.startswith(query):
-                topic_canonical = canon
-                break
+        # First topic (alphabetically) that starts with the query
+        idx = bisect_left(TOPIC_NAMES, query)
+        if idx < len(TOPIC_NAMES) and TOPIC_NAMES[idx].startswith(query):
+            topic_canonical = TOPIC_NAME_MAP[TOPIC_NAMES[idx]]
 
     if not topic_canonical:
         await message.answer("Мындай тема табылган жок. /topics командасын кара.")
@@ -445,16 +459,14 @@ async def topic_handler(message: Message):
 
     qnums = TOPIC_INDEX[topic_canonical]
     qnum = random.choice(qnums)
-    q = QUESTION_INDEX[qnum]
     await send_question_universal(
-        message.bot, message.from_user.id, q, qnum, nav_mode="manual"
+        message.bot, message.from_user.id, qnum, nav_mode="manual"
     )
 
 
 # -------------------------------------
 # ADMIN COMMANDS
 # -------------------------------------
-@router.message(F.text == "/admin_stats")
 async def admin_stats_handler(message: Message):
     user_id = message.from_user.id
     
@@ -464,24 +476,20 @@ async def admin_stats_handler(message: Message):
         return
     
     try:
-        dau = await db.get_dau_today()
-        attempts_today = await db.get_attempts_today()
-        attempts_total = await db.get_attempts_total()
-        accuracy = await db.get_accuracy()
+        snapshot = await db.get_today_snapshot()
         
         text = (
             "📊 **Статистика (Admin)**\n\n"
-            f"👥 DAU сегодня: {dau}\n"
-            f"📝 Попытки сегодня: {attempts_today}\n"
-            f"📊 Попытки всего: {attempts_total}\n"
-            f"✅ Accuracy: {accuracy:.1f}%"
+            f"👥 DAU сегодня: {snapshot.dau}\n"
+            f"📝 Попытки сегодня: {snapshot.attempts_today}\n"
+            f"📊 Попытки всего: {snapshot.attempts_total}\n"
+            f"✅ Accuracy: {snapshot.accuracy:.1f}%"
         )
         await message.answer(text)
     except Exception as e:
         await message.answer(f"❌ Ошибка получения статистики: {e}")
 
 
-@router.message(F.text == "/admin_daily")
 async def admin_daily_handler(message: Message):
     user_id = message.from_user.id
     
@@ -511,71 +519,91 @@ async def admin_daily_handler(message: Message):
         await message.answer(f"❌ Ошибка получения данных: {e}")
 
 
+# -------------------------------------
+# EXACT-MATCH COMMANDS (one filter + dispatch table)
+# -------------------------------------
+COMMAND_HANDLERS = {
+    "/random": random_handler,
+    "/stats": stats_handler,
+    "/review_wrong": review_wrong_handler,
+    "/topics": topics_handler,
+    "/admin_stats": admin_stats_handler,
+    "/admin_daily": admin_daily_handler,
+}
+
+
+@router.message(F.text.in_(set(COMMAND_HANDLERS)))
+async def command_handler(message: Message):
+    await COMMAND_HANDLERS[message.text](message)
+
+
 # -------------------------------------
 # NAVIGATION BUTTONS (Prev/Next)
 # -------------------------------------
-@router.callback_query(F.data.startswith("nav_prev|"))
-async def nav_prev(callback: CallbackQuery, bot: Bot):
-    _, qnum = callback.data.split("|")
-    cur = int(qnum)
-    prev_num = str(cur - 1)
-    if prev_num not in QUESTION_INDEX:
+@router.callback_query(NavCallback.filter(F.step < 0))
+async def nav_prev(callback: CallbackQuery, callback_data: NavCallback, bot: Bot):
+    prev_num = callback_data.qnum - 1
+    if not question_exists(prev_num):
         await callback.message.answer("Бул биринчи суроо.")
         await callback.answer()
         return
 
-    q = QUESTION_INDEX[prev_num]
-    await send_question_universal(bot, callback.from_user.id, q, prev_num, nav_mode="manual")
+    await send_question_universal(bot, callback.from_user.id, prev_num, nav_mode="manual")
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("nav_next|"))
-async def nav_next(callback: CallbackQuery, bot: Bot):
-    _, qnum = callback.data.split("|")
-    cur = int(qnum)
-    next_num = str(cur + 1)
-    if next_num not in QUESTION_INDEX:
+@router.callback_query(NavCallback.filter(F.step > 0))
+async def nav_next(callback: CallbackQuery, callback_data: NavCallback, bot: Bot):
+    next_num = callback_data.qnum + 1
+    if not question_exists(next_num):
         await callback.message.answer("Бул акыркы суроо.")
         await callback.answer()
         return
 
-    q = QUESTION_INDEX[next_num]
-    await send_question_universal(bot, callback.from_user.id, q, next_num, nav_mode="manual")
+    await send_question_universal(bot, callback.from_user.id, next_num, nav_mode="manual")
     await callback.answer()
 
 
 # -------------------------------------
 # ANSWER HANDLER (always with explanation)
 # -------------------------------------
-@router.callback_query(F.data.startswith("answer|"))
-async def answer_handler(callback: CallbackQuery, bot: Bot):
-    _, qid, choice, nav_mode, qnum = callback.data.split("|")
+@router.callback_query(AnswerCallback.filter())
+async def answer_handler(callback: CallbackQuery, callback_data: AnswerCallback, bot: Bot):
+    qid = callback_data.qid
+    choice = callback_data.letter
+    nav_mode = callback_data.nav
 
-    q = QUESTION_INDEX[qnum]
-    correct = q.get("answer") or q.get("correct")
-    explanation = q.get("explanation_kg") or q.get("explanation") or ""
+    qnum = ID_TO_QNUM.get(qid)
+    if qnum is None:
+        await callback.message.answer("Бул суроо табылган жок.")
+        await callback.answer()
+        return
+
+    i = qnum - 1
+    correct = Q_ANSWER[i]
+    explanation = Q_EXPLANATION[i]
 
     is_correct = (choice == correct)
     user_id = callback.from_user.id
 
     # Update stats
-    update_stats(user_id, q, qnum, is_correct)
+    await state.update_stats(user_id, qnum, Q_DIFF[i] or "unknown", is_correct)
 
     # Log attempt and answer_submitted
     await db.log_attempt(
         user_id=user_id,
         question_id=qid,
-        question_num=qnum,
+        question_num=str(qnum),
         user_answer=choice,
         correct_answer=correct,
         is_correct=is_correct,
-        difficulty=q.get("difficulty"),
-        topic=q.get("topic")
+        difficulty=Q_DIFF[i],
+        topic=Q_TOPIC[i]
     )
     await db.log_event(
         user_id,
         "answer_submitted",
-        {"question_id": qid, "question_num": qnum, "is_correct": is_correct}
+        {"question_id": qid, "question_num": str(qnum), "is_correct": is_correct}
     )
 
     if is_correct:
@@ -583,7 +611,7 @@ async def answer_handler(callback: CallbackQuery, bot: Bot):
     else:
         result = (
             f"❌ Туура эмес.\n"
-            f"Туура жооп: {correct}) {q['options'][correct]}"
+            f"Туура жооп: {correct}) {Q_OPTIONS[i][correct]}"
         )
 
     text = f"{result}\n\nТүшүндүрмө:\n{explanation}"
@@ -592,15 +620,34 @@ async def answer_handler(callback: CallbackQuery, bot: Bot):
 
     # SEQUENTIAL navigation -> go to next question in this difficulty
     if nav_mode == "sequential":
-        progress = USER_PROGRESS.get(user_id)
+        progress = await state.get_progress(user_id)
         if progress:
-            progress["index"] += 1
-            USER_PROGRESS[user_id] = progress
-            await send_sequential(bot, user_id, progress["difficulty"])
+            idx = progress["index"] + 1
+            await state.set_progress(user_id, progress["difficulty"], idx)
+            await send_sequential(bot, user_id, progress["difficulty"], idx=idx)
 
     await callback.answer()
 
 
+# -------------------------------------
+# LEGACY BUTTONS ("kind|field|..." callback data)
+# -------------------------------------
+@router.callback_query(F.data.regexp(r"^(answer|nav_prev|nav_next|level)\|"))
+async def legacy_callback_handler(callback: CallbackQuery, bot: Bot):
+    # Messages sent before the typed callback data still have these buttons
+    kind, *fields = callback.data.split("|")
+    if kind == "answer":
+        qid, letter, nav_mode = fields[:3]  # trailing qnum (older format) is ignored
+        data = AnswerCallback(qid=qid, letter=letter, nav=nav_mode)
+        await answer_handler(callback, data, bot)
+    elif kind == "level":
+        await level_handler(callback, LevelCallback(difficulty=fields[0]), bot)
+    elif kind == "nav_prev":
+        await nav_prev(callback, NavCallback(step=-1, qnum=int(fields[0])), bot)
+    else:
+        await nav_next(callback, NavCallback(step=1, qnum=int(fields[0])), bot)
+
+
 # -------------------------------------
 # FALLBACK HANDLER
 # -------------------------------------
@@ -614,16 +661,15 @@ async def fallback_handler(message: Message):
 
     user_id = message.from_user.id
 
-    if user_id not in SEEN_USERS:
-        SEEN_USERS.add(user_id)
-        # Log user_start for new users
-        await db.ensure_user(
+    if await state.mark_seen(user_id):
+        # Log user_start for new users (also creates/updates the user)
+        await db.log_event(
             user_id,
+            "user_start",
             username=message.from_user.username,
             first_name=message.from_user.first_name,
             last_name=message.from_user.last_name
         )
-        await db.log_event(user_id, "user_start")
         await send_intro(message)
     else:
         await message.answer(
@@ -641,25 +687,15 @@ async def fallback_handler(message: Message):
 # MAIN
 # -------------------------------------
 async def main():
+    # DB and user state are opened/closed by render_main.py around this
     if not BOT_TOKEN:
         print("WARNING: BOT_TOKEN not found. Bot will not start.")
         return
     
-    # Initialize database
-    await db.init_db()
-    
     load_questions()
     bot = Bot(token=BOT_TOKEN)
     dp = Dispatcher()
     dp.include_router(router)
 
     print("BOT IS RUNNING...")
-    try:
-        await dp.start_polling(bot)
-    finally:
-        await db.close_db()
-
-
-@app.on_event("startup")
-async def startup_event():
-    asyncio.create_task(main())
\ No newline at end of file
+    await dp.start_polling(bot)
\ No newline at end of file
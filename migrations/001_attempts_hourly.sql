@@ -0,0 +1,28 @@
+-- Migration: attempts_hourly aggregates
+-- For databases created from an older schema.sql.
+-- Order matters:
+--   1. Run this file before deploying: the new code writes to attempts_hourly
+--      and every attempt write fails while the table is missing.
+--   2. Deploy.
+--   3. Run the backfill below again (best at a quiet moment): attempts the old
+--      code wrote between steps 1 and 2 never reached attempts_hourly.
+-- The backfill recounts each hour from attempts, so re-running it is safe.
+
+CREATE TABLE IF NOT EXISTS attempts_hourly (
+    hour TIMESTAMPTZ PRIMARY KEY,
+    total INT NOT NULL DEFAULT 0,
+    correct INT NOT NULL DEFAULT 0
+);
+
+-- Backfill from existing attempts (step 1 and again in step 3)
+INSERT INTO attempts_hourly (hour, total, correct)
+SELECT
+    date_trunc('hour', created_at AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+    COUNT(*),
+    COUNT(*) FILTER (WHERE is_correct)
+FROM attempts
+GROUP BY 1
+ON CONFLICT (hour)
+DO UPDATE SET
+    total = EXCLUDED.total,
+    correct = EXCLUDED.correct;
@@ -0,0 +1,24 @@
+-- Migration: covering indexes for the analytics queries
+-- CONCURRENTLY does not block writes but cannot run inside a transaction:
+-- execute these statements one by one (psql autocommit is fine).
+
+-- get_dau_today: COUNT(DISTINCT user_id) WHERE created_at >= ...
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_events_created_user
+    ON events(created_at, user_id);
+
+-- idx_events_created_at(created_at) is a prefix of idx_events_created_user:
+-- drop it after the new index is built, it only slows down inserts
+DROP INDEX CONCURRENTLY IF EXISTS idx_events_created_at;
+
+-- get_top_users_last_7_days: WHERE created_at >= ... AND is_correct GROUP BY user_id
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_attempts_correct_created_user
+    ON attempts(created_at, user_id)
+    WHERE is_correct;
+
+-- Check the plans, expect "Index Only Scan" instead of "Seq Scan":
+-- EXPLAIN (ANALYZE, BUFFERS)
+--     SELECT COUNT(DISTINCT user_id) FROM events WHERE created_at >= NOW() - INTERVAL '1 day';
+-- EXPLAIN (ANALYZE, BUFFERS)
+--     SELECT user_id, COUNT(*) FROM attempts
+--     WHERE created_at >= NOW() - INTERVAL '7 days' AND is_correct = true
+--     GROUP BY user_id;
@@ -1,12 +1,41 @@
 import os
 import asyncio
+import logging
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 import uvicorn
 
+import db
+import state
 import main as bot_module  # импортируем твой бот как модуль
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+
+def _log_bot_exit(task: asyncio.Task):
+    # без этого падение бота (плохой токен, сеть) проходит молча
+    if not task.cancelled() and task.exception():
+        logger.error("Bot task crashed", exc_info=task.exception())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # единственный старт: БД, state и бот поднимаются один раз здесь
+    await db.init_db()
+    await state.init_state()
+    bot_task = asyncio.get_running_loop().create_task(bot_module.main())
+    bot_task.add_done_callback(_log_bot_exit)
+    try:
+        yield
+    finally:
+        bot_task.cancel()
+        await asyncio.gather(bot_task, return_exceptions=True)
+        await state.close_state()
+        await db.close_db()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/")
@@ -14,16 +43,8 @@ async def root():
     return {"status": "ok", "message": "SAT Kyrgyz bot is running"}
 
 
-async def start_bot():
-    # запускаем твоего бота
-    await bot_module.main()
-
-
 async def main():
-    # параллельно запускаем бота и HTTP-сервер
-    loop = asyncio.get_event_loop()
-    loop.create_task(start_bot())
-
+    # HTTP-сервер; бот запускается в lifespan вместе с ним
     port = int(os.environ.get("PORT", 8000))
     config = uvicorn.Config(app, host="0.0.0.0", port=port, log_level="info")
     server = uvicorn.Server(config)
@@ -31,4 +52,10 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop: faster event loop for the bot, asyncpg and uvicorn (not on Windows)
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
@@ -34,16 +34,27 @@ CREATE TABLE IF NOT EXISTS attempts (
     created_at TIMESTAMPTZ DEFAULT NOW() NOT NULL
 );
 
+-- Attempts per UTC hour: running totals maintained on every attempt insert,
+-- read by the analytics queries instead of scanning attempts
+CREATE TABLE IF NOT EXISTS attempts_hourly (
+    hour TIMESTAMPTZ PRIMARY KEY,
+    total INT NOT NULL DEFAULT 0,
+    correct INT NOT NULL DEFAULT 0
+);
+
 -- Indexes for performance
 CREATE INDEX IF NOT EXISTS idx_events_user_id ON events(user_id);
 CREATE INDEX IF NOT EXISTS idx_events_type ON events(event_type);
-CREATE INDEX IF NOT EXISTS idx_events_created_at ON events(created_at);
 CREATE INDEX IF NOT EXISTS idx_events_user_created ON events(user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_events_created_user ON events(created_at, user_id);
 
 CREATE INDEX IF NOT EXISTS idx_attempts_user_id ON attempts(user_id);
 CREATE INDEX IF NOT EXISTS idx_attempts_created_at ON attempts(created_at);
 CREATE INDEX IF NOT EXISTS idx_attempts_user_created ON attempts(user_id, created_at);
 CREATE INDEX IF NOT EXISTS idx_attempts_question_id ON attempts(question_id);
+-- Partial index for top users by correct answers (index-only scan)
+CREATE INDEX IF NOT EXISTS idx_attempts_correct_created_user ON attempts(created_at, user_id)
+    WHERE is_correct;
 
 -- Function to update updated_at timestamp
 CREATE OR REPLACE FUNCTION update_updated_at_column()
@@ -0,0 +1,281 @@
+"""
+Per-user bot state: stats, sequential progress and seen users.
+Uses Redis (redis.asyncio) when REDIS_URL is set, so state survives restarts
+and is shared between workers. Without it, state lives in process memory.
+All functions are safe: if Redis is unavailable, they log and fall back to defaults.
+"""
+import os
+import logging
+import random
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Set
+import redis.asyncio as redis
+
+logger = logging.getLogger(__name__)
+
+# Global Redis client (has its own connection pool)
+_redis: Optional[redis.Redis] = None
+
+PROGRESS_TTL = 86400  # seconds
+RECENT_WRONG_LIMIT = 10  # wrong qnums shown in /stats
+
+# In-process storage, used when Redis is not configured
+USER_STATS: Dict[int, "UserStats"] = {}         # user_id -> UserStats
+USER_WRONG: Dict[int, "WrongQuestions"] = {}    # user_id -> WrongQuestions
+USER_PROGRESS: Dict[int, Dict] = {}             # user_id -> {"difficulty":, "index":}
+SEEN_USERS: Set[int] = set()                    # user_ids that already received intro
+
+
+@dataclass(slots=True)
+class UserStats:
+    """What /stats shows; the same in both backends."""
+    total: int = 0
+    correct: int = 0
+    acc_pct: float = 0.0
+    by_diff: dict = field(default_factory=dict)  # diff -> {"total":, "correct":, "pct":}
+    wrong_count: int = 0
+    wrong_recent: deque = field(                 # latest wrong qnums, newest first
+        default_factory=lambda: deque(maxlen=RECENT_WRONG_LIMIT)
+    )
+
+
+@dataclass(slots=True)
+class WrongQuestions:
+    """In-memory set of wrong qnums with O(1) add, discard and random pick."""
+    qnums: list = field(default_factory=list)  # unordered
+    pos: dict = field(default_factory=dict)    # qnum -> its index in qnums
+
+    def add(self, qnum: int):
+        if qnum not in self.pos:
+            self.pos[qnum] = len(self.qnums)
+            self.qnums.append(qnum)
+
+    def discard(self, qnum: int):
+        # O(1): move the last item into the freed slot
+        idx = self.pos.pop(qnum, None)
+        if idx is None:
+            return
+        last = self.qnums.pop()
+        if idx < len(self.qnums):
+            self.qnums[idx] = last
+            self.pos[last] = idx
+
+
+async def init_state():
+    """Connect to Redis if REDIS_URL is set."""
+    global _redis
+    if _redis:
+        return
+
+    redis_url = os.getenv("REDIS_URL")
+    if not redis_url:
+        logger.warning("REDIS_URL not found. User state will be kept in memory.")
+        return
+
+    try:
+        client = redis.from_url(redis_url, decode_responses=True, max_connections=10)
+        await client.ping()
+        _redis = client
+        logger.info("Redis connection pool created.")
+    except Exception as e:
+        logger.error(f"Failed to connect to Redis: {e}")
+        _redis = None
+
+
+async def close_state():
+    """Close Redis connection pool."""
+    global _redis
+    if _redis:
+        await _redis.aclose()
+        _redis = None
+        logger.info("Redis connection pool closed.")
+
+
+def _stats_key(user_id: int) -> str:
+    return f"user:{user_id}:stats"
+
+
+def _wrong_key(user_id: int) -> str:
+    return f"user:{user_id}:wrong"
+
+
+def _recent_key(user_id: int) -> str:
+    return f"user:{user_id}:wrong_recent"
+
+
+def _progress_key(user_id: int) -> str:
+    return f"user:{user_id}:progress"
+
+
+def _pct(part: int, total: int) -> float:
+    return (part / total) * 100 if total > 0 else 0.0
+
+
+def _refill_recent(recent: deque, wrong_qnums: list):
+    """Append older wrong qnums to `recent` until it is full or has them all."""
+    for qnum in wrong_qnums:
+        if len(recent) == recent.maxlen:
+            return
+        if qnum not in recent:
+            recent.append(qnum)
+
+
+# Seen users
+
+async def mark_seen(user_id: int) -> bool:
+    """Mark user as seen. Returns True if this is the first time."""
+    if not _redis:
+        if user_id in SEEN_USERS:
+            return False
+        SEEN_USERS.add(user_id)
+        return True
+
+    try:
+        return await _redis.sadd("seen_users", user_id) == 1
+    except Exception as e:
+        logger.error(f"Error marking user {user_id} as seen: {e}")
+        return False
+
+
+# Sequential progress
+
+async def get_progress(user_id: int) -> Optional[Dict]:
+    """Get {"difficulty":, "index":} for the user, or None."""
+    if not _redis:
+        return USER_PROGRESS.get(user_id)
+
+    try:
+        value = await _redis.get(_progress_key(user_id))
+        if not value:
+            return None
+        difficulty, index = value.rsplit(":", 1)
+        return {"difficulty": difficulty, "index": int(index)}
+    except Exception as e:
+        logger.error(f"Error getting progress for user {user_id}: {e}")
+        return None
+
+
+async def set_progress(user_id: int, difficulty: str, index: int):
+    """Store the user's position in a difficulty level."""
+    if not _redis:
+        USER_PROGRESS[user_id] = {"difficulty": difficulty, "index": index}
+        return
+
+    try:
+        await _redis.set(_progress_key(user_id), f"{difficulty}:{index}", ex=PROGRESS_TTL)
+    except Exception as e:
+        logger.error(f"Error setting progress for user {user_id}: {e}")
+
+
+# Stats
+
+async def get_user_stats(user_id: int) -> Optional[UserStats]:
+    """Get the user's stats, or None if there are none yet."""
+    if not _redis:
+        return USER_STATS.get(user_id)
+
+    try:
+        async with _redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(_stats_key(user_id))
+            pipe.scard(_wrong_key(user_id))
+            pipe.lrange(_recent_key(user_id), 0, RECENT_WRONG_LIMIT - 1)
+            counters, wrong_count, recent = await pipe.execute()
+    except Exception as e:
+        logger.error(f"Error getting stats for user {user_id}: {e}")
+        return None
+
+    if not counters and not wrong_count:
+        return None
+
+    # Hash fields: "total", "correct", "total:<diff>", "correct:<diff>"
+    stats = UserStats(
+        total=int(counters.pop("total", 0)),
+        correct=int(counters.pop("correct", 0)),
+        wrong_count=wrong_count,
+    )
+    stats.acc_pct = _pct(stats.correct, stats.total)
+    for name, value in counters.items():
+        kind, _, diff = name.partition(":")
+        stats.by_diff.setdefault(diff, {"total": 0, "correct": 0})[kind] = int(value)
+    for d in stats.by_diff.values():
+        d["pct"] = _pct(d["correct"], d["total"])
+    stats.wrong_recent.extend(int(qnum) for qnum in recent)
+
+    # corrected answers leave the recent list; top it up from the wrong set
+    if len(stats.wrong_recent) < min(wrong_count, RECENT_WRONG_LIMIT):
+        try:
+            more = await _redis.srandmember(_wrong_key(user_id), RECENT_WRONG_LIMIT)
+        except Exception as e:
+            logger.error(f"Error getting wrong questions for user {user_id}: {e}")
+            more = []
+        _refill_recent(stats.wrong_recent, [int(qnum) for qnum in more])
+    return stats
+
+
+async def update_stats(user_id: int, qnum: int, difficulty: str, is_correct: bool):
+    """Count an answer and update the user's wrong questions."""
+    if not _redis:
+        stats = USER_STATS.get(user_id)
+        if stats is None:
+            stats = USER_STATS[user_id] = UserStats()
+
+        stats.total += 1
+        if is_correct:
+            stats.correct += 1
+        stats.acc_pct = _pct(stats.correct, stats.total)
+
+        by_diff = stats.by_diff.setdefault(difficulty, {"total": 0, "correct": 0})
+        by_diff["total"] += 1
+        if is_correct:
+            by_diff["correct"] += 1
+        by_diff["pct"] = _pct(by_diff["correct"], by_diff["total"])
+
+        # wrong questions
+        wrong = USER_WRONG.get(user_id)
+        if wrong is None:
+            wrong = USER_WRONG[user_id] = WrongQuestions()
+        if qnum in stats.wrong_recent:
+            stats.wrong_recent.remove(qnum)
+        if is_correct:
+            wrong.discard(qnum)
+            _refill_recent(stats.wrong_recent, wrong.qnums)
+        else:
+            wrong.add(qnum)
+            stats.wrong_recent.appendleft(qnum)
+        stats.wrong_count = len(wrong.qnums)
+        return
+
+    try:
+        async with _redis.pipeline(transaction=False) as pipe:
+            key = _stats_key(user_id)
+            pipe.hincrby(key, "total", 1)
+            pipe.hincrby(key, f"total:{difficulty}", 1)
+            pipe.lrem(_recent_key(user_id), 0, qnum)
+            if is_correct:
+                pipe.hincrby(key, "correct", 1)
+                pipe.hincrby(key, f"correct:{difficulty}", 1)
+                pipe.srem(_wrong_key(user_id), qnum)
+            else:
+                pipe.sadd(_wrong_key(user_id), qnum)
+                pipe.lpush(_recent_key(user_id), qnum)
+                pipe.ltrim(_recent_key(user_id), 0, RECENT_WRONG_LIMIT - 1)
+            await pipe.execute()
+    except Exception as e:
+        logger.error(f"Error updating stats for user {user_id}: {e}")
+
+
+async def random_wrong(user_id: int) -> Optional[int]:
+    """A random qnum the user answered wrong, or None."""
+    if not _redis:
+        wrong = USER_WRONG.get(user_id)
+        if not wrong or not wrong.qnums:
+            return None
+        return random.choice(wrong.qnums)
+
+    try:
+        qnum = await _redis.srandmember(_wrong_key(user_id))
+        return int(qnum) if qnum is not None else None
+    except Exception as e:
+        logger.error(f"Error getting wrong question for user {user_id}: {e}")
+        return None